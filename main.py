@@ -4,14 +4,22 @@
 import pdfrw
 import argparse
 import json
+import concurrent.futures
+import io
+import logging
+import os
+import sys
 
 import redcap_helpers
 
 from pathlib import Path
 from datetime import datetime
+from typing import Optional
 
 SECRETS_FILE = Path("secrets.json")
 
+logger = logging.getLogger(__name__)
+
 # Constants used for digging through PDFs
 ANNOT_KEY = '/Annots'
 ANNOT_FIELD_KEY = '/T'
@@ -23,11 +31,28 @@ PARENT_KEY = '/Parent'
 APPEARANCE_KEY = '/AP'
 D_KEY = '/D'
 
+# Prefix of the variables REDCap adds to exported records itself (event name, repeating instrument/instance, ...)
+REDCAP_SYSTEM_FIELD_PREFIX = "redcap_"
+
+# Suffix of the extra text value added for each radio button (see convert_checkboxes_and_radio_buttons())
+RADIO_BUTTON_CHOICE_SUFFIX = "__rchoice"    # Default "__rchoice"
+
+# Shared PDF objects for checkbox states; annotation.update() copies these entries rather than keeping the dicts
+_YES = pdfrw.PdfName('Yes')
+_OFF = pdfrw.PdfName('Off')
+_CHECKED = pdfrw.PdfDict(AS=_YES, V=_YES)
+_UNCHECKED = pdfrw.PdfDict(AS=_OFF, V=_OFF)
+
+# Radio button choices seen so far, mapped to their PDF name (see _pdf_name())
+_PDF_NAME_CACHE = dict()
+
 parser = argparse.ArgumentParser(description="REDCap PDF Auto-fill Core")
 parser.add_argument("-id", "--identifier", required=True, help="Unique ID of a REDCap record to fill out a template PDF")
 parser.add_argument("-v", "--record-variable", nargs='?', default='record_id', const='record_id', help="Name of the REDCap variable that uniquely identifies each record (default: record_id)")
 parser.add_argument("-i", "--input-pdf", required=True, help="Path to an empty template .pdf file that will contain the data from a REDCap record")
 parser.add_argument("-o", "--output-pdf", help="Path to a new .pdf file that will be created and filled in with data from a REDCap record")
+parser.add_argument("--verbose", action="store_true", help="Display progress messages")
+parser.add_argument("--debug", action="store_true", help="Display progress messages and the prepared record data (implies --verbose)")
 
 ################################################################
 ################################################################
@@ -44,20 +69,20 @@ def get_cmd_line_input(inp: argparse.Namespace) -> tuple[str, str, Path, Path]:
     if not inp.output_pdf:
         # User did not specify an output location
         default_output_pdf = f"./output/{datetime.now().strftime('%Y%m%d_%H%M%S')}_{input_pdf_path.stem}_{inp.identifier}.pdf"
-        print("No output PDF file specified; writing filled PDF to:", default_output_pdf)
+        logger.warning("No output PDF file specified; writing filled PDF to: %s", default_output_pdf)
         output_pdf_path = Path(default_output_pdf)
     else:
         if not inp.output_pdf.endswith(".pdf"):
             # Don't stop the script, just display a warning
-            print("Warning: Output PDF does not have a '.pdf' extension: " + inp.output_pdf)
-            print("         Auto-filling will continue to function, but you may have trouble opening the output PDF.")
+            logger.warning("Output PDF does not have a '.pdf' extension: %s\n"
+                           "Auto-filling will continue to function, but you may have trouble opening the output PDF.", inp.output_pdf)
         output_pdf_path = Path(inp.output_pdf)
 
     if input_pdf_path == output_pdf_path:
         raise FileExistsError(f"Template PDF and output PDF must be different: {inp.input_pdf}")
 
     input_pack = (inp.identifier, inp.record_variable, input_pdf_path, output_pdf_path)
-    print(f"Inputs: Record:\t\t{input_pack[0]}\n\tREDCap var:\t{input_pack[1]}\n\tTemplate PDF:\t{input_pack[2]}\n\tOutput PDF:\t{input_pack[3]}")
+    logger.info("Inputs: Record:\t\t%s\n\tREDCap var:\t%s\n\tTemplate PDF:\t%s\n\tOutput PDF:\t%s", *input_pack)
     return input_pack
 
 def load_secrets(json_file_path: str) -> dict:
@@ -71,11 +96,20 @@ def load_secrets(json_file_path: str) -> dict:
         return result
     raise ValueError("Failed to load secrets.json - did you fill in your REDCap project's API key and URL?")
 
-def get_pdf_fields(input_pdf_path: Path) -> list[str]:
-    '''Returns a list of field names in the PDF file specifed by input_pdf_path, listed in order of appearance.
+def _pdf_name(value: str) -> str:
+    '''Returns pdfrw.PdfName(value), reusing the name object created for a previously seen value.
+    '''
+    name = _PDF_NAME_CACHE.get(value)
+    if name is None:
+        name = _PDF_NAME_CACHE[value] = pdfrw.PdfName(value)
+    return name
+
+def _iter_widgets(template_pdf: pdfrw.PdfReader):
+    '''Yields a 3-tuple (annotation, key, is_grouped) for every named widget annotation in template_pdf, in order of appearance.
+    key is the field name with pdfrw's surrounding parentheses removed, interned with sys.intern() since the same
+    name repeats across grouped widgets and pages (and is looked up in the data dictionary for each one).
+    is_grouped is True when the name comes from the widget's parent ('/Parent' > '/T') instead of from the widget itself ('/T').
     '''
-    template_pdf = pdfrw.PdfReader(input_pdf_path)
-    result = []
     for page in template_pdf.pages:
         annotations = page[ANNOT_KEY]
         if annotations is None:
@@ -83,20 +117,59 @@ def get_pdf_fields(input_pdf_path: Path) -> list[str]:
         for annotation in annotations:
             if annotation[SUBTYPE_KEY] == WIDGET_SUBTYPE_KEY:
                 if annotation[ANNOT_FIELD_KEY]:                 ### Isolated fields ("has a '/T' field")
-                    key = annotation[ANNOT_FIELD_KEY][1:-1]
-                    if '___' in key:                            # Checkboxes have a default '___' separator after the field name
-                        key = key.split('___')[0]
-                    if key not in result:
-                        result.append(key)
+                    yield annotation, sys.intern(annotation[ANNOT_FIELD_KEY][1:-1]), False
                 elif annotation[PARENT_KEY][ANNOT_FIELD_KEY]:   ### Grouped fields ("has a '/Parent' > '/T' field")
-                    group = annotation[PARENT_KEY][ANNOT_FIELD_KEY][1:-1]
-                    if '___' in group:
-                        group = group.split('___')[0]
-                    if group not in result:
-                        result.append(group)
-    return result
-
-def convert_checkboxes_and_radio_buttons(r: dict, md: list[dict]) -> dict:
+                    yield annotation, sys.intern(annotation[PARENT_KEY][ANNOT_FIELD_KEY][1:-1]), True
+
+def get_pdf_fields(template_pdf: pdfrw.PdfReader) -> list[str]:
+    '''Returns a list of field names in the parsed PDF template_pdf, listed in order of appearance.
+    '''
+    result: dict[str, None] = {}                                # Insertion-ordered, with O(1) de-duplication
+    for _, key, _ in _iter_widgets(template_pdf):
+        if '___' in key:                                        # Checkboxes have a default '___' separator after the field name
+            key = key.split('___')[0]
+        result.setdefault(key, None)
+    return list(result)
+
+def _pdf_field_variable(pdf_field: str, md_view: redcap_helpers.MetadataView) -> Optional[str]:
+    '''Returns the REDCap variable that holds the data for PDF field pdf_field, or None if the project has no such variable.
+    PDF fields named after a radio button's choice ('{radio_button_variable}__rchoice') need their radio button variable,
+    and instrument status fields ('{form_name}_complete') are kept even though the metadata doesn't list them.
+    '''
+    if pdf_field.endswith(RADIO_BUTTON_CHOICE_SUFFIX):
+        pdf_field = pdf_field[:-len(RADIO_BUTTON_CHOICE_SUFFIX)]
+    if pdf_field in md_view.field_types or pdf_field in md_view.form_complete_fields:
+        return pdf_field
+    return None
+
+def get_unknown_pdf_fields(pdf_fields: list[str], md_view: redcap_helpers.MetadataView) -> list[str]:
+    '''Returns the PDF fields in pdf_fields (the output of get_pdf_fields()) that don't match any variable in the project metadata.
+    REDCap's own 'redcap_*' fields are never listed in the metadata, so they aren't counted as unknown.
+    '''
+    return [f for f in pdf_fields
+            if not f.startswith(REDCAP_SYSTEM_FIELD_PREFIX) and _pdf_field_variable(f, md_view) is None]
+
+def get_record_fields(pdf_fields: list[str], md_view: redcap_helpers.MetadataView, redcap_unique_identifier: str) -> Optional[list[str]]:
+    '''Returns the list of REDCap variables needed to fill the PDF fields pdf_fields (the output of get_pdf_fields()),
+    starting with redcap_unique_identifier, or None if the whole record is needed.
+    PDF fields that aren't REDCap variables (see _pdf_field_variable()) are left out with a warning,
+    since the REDCap API rejects unknown field names.
+    If the PDF uses any of REDCap's own 'redcap_*' fields (e.g. 'redcap_event_name'), None is returned so that
+    the whole record is requested, as these can't be looked up in the metadata.
+    '''
+    if any(f.startswith(REDCAP_SYSTEM_FIELD_PREFIX) for f in pdf_fields):
+        return None
+    unknown_fields = get_unknown_pdf_fields(pdf_fields, md_view)
+    if unknown_fields:
+        logger.warning("PDF fields not found in the REDCap project will be left empty: %s", ", ".join(unknown_fields))
+    result = {redcap_unique_identifier: None}
+    for pdf_field in pdf_fields:
+        redcap_variable = _pdf_field_variable(pdf_field, md_view)
+        if redcap_variable is not None:
+            result.setdefault(redcap_variable, None)
+    return list(result)
+
+def convert_checkboxes_and_radio_buttons(r: dict, md_view: redcap_helpers.MetadataView) -> dict:
     '''Prepares an API-provided record to contain data that can be written to a PDF.
     * Checkbox key/value pairs are changed from
         '{checkbox_name}': '0' or '{checkbox_name}': '1'
@@ -108,10 +181,10 @@ def convert_checkboxes_and_radio_buttons(r: dict, md: list[dict]) -> dict:
         '{radio_button_variable}': {
             'choice': True
         }
+    md_view is the output of redcap_helpers.parse_metadata().
     '''
-    radio_buttons,checkboxes = redcap_helpers.get_radio_buttons_checkboxes(md)
-
-    RADIO_BUTTON_CHOICE_SUFFIX = "__rchoice"    # Default "__rchoice"
+    checkbox_set = md_view.checkboxes
+    radio_set = md_view.radios
 
     num_checkboxes_edited = 0
     num_radio_buttons_edited = 0
@@ -124,15 +197,15 @@ def convert_checkboxes_and_radio_buttons(r: dict, md: list[dict]) -> dict:
         #           '___'   =   auto-generated separator
         #           '3'     =   choice                              ("Choice 3")
         #           '1'     =   '1' if checked, '0' if unchecked    (choice 3 is checked)
-        checkbox_token_check = redcap_variable.split('___')
-        redcap_value = r[redcap_variable]
+        sep_idx = redcap_variable.find('___')
         # Checkboxes:
-        if len(checkbox_token_check) > 1 and checkbox_token_check[0] in checkboxes:
-            # If the split() worked, then the resultant list would have 2 or more elements and redcap_variable is a checkbox
-            r[redcap_variable] = redcap_value == '1'    # Change str to bool
+        if sep_idx != -1 and redcap_variable[:sep_idx] in checkbox_set:
+            # If the separator was found and the text before it is a checkbox field, then redcap_variable is a checkbox
+            r[redcap_variable] = r[redcap_variable] == '1'    # Change str to bool
             num_checkboxes_edited += 1
-        # Radio buttons (split() should do nothing if it couldn't find the separator string):
-        elif redcap_variable in radio_buttons:
+        # Radio buttons:
+        elif redcap_variable in radio_set:
+            redcap_value = r[redcap_variable]
             r[redcap_variable] = {redcap_value: True}   # redcap_value is the *raw value* of the radio button that was picked (not the display text)
             num_radio_buttons_edited += 1
             if redcap_value != "":
@@ -144,27 +217,27 @@ def convert_checkboxes_and_radio_buttons(r: dict, md: list[dict]) -> dict:
     # print(f">>> Edited fields: {num_checkboxes_edited} checkboxes, {num_radio_buttons_edited} radio buttons ({len(new_dict_of_radio_values)} additional text fields added)")
     return r
 
-def convert_dropdowns_to_strings(r: dict, md: list[dict]) -> dict:
+def convert_dropdowns_to_strings(r: dict, md_view: redcap_helpers.MetadataView) -> dict:
     '''Returns a formatted version of record r where any dropdown variables have their value overwritten with
     their accompanying display text (instead of their raw value).
+    md_view is the output of redcap_helpers.parse_metadata().
     '''
     # Had trouble with overriding PDF dropdowns - instead, REDCap dropdowns can be written to plain text boxes in template PDFs.
     # Page 445? https://www.adobe.com/content/dam/acom/en/devnet/pdf/pdfs/PDF32000_2008.pdf
-    proj_multi_choice_text = redcap_helpers.get_multiple_choice_text(md)
-    for field in md:
-        if field['field_type'] == 'dropdown':
-            dropdown_var_name = field['field_name']
-            if r[dropdown_var_name] != "":
-                r[dropdown_var_name] = proj_multi_choice_text[dropdown_var_name][r[dropdown_var_name]]
+    for dropdown_var_name in [f for f in md_view.field_types if f in md_view.dropdowns]:   # Metadata order
+        # The record may only contain the fields used by the template PDF
+        if r.get(dropdown_var_name, "") != "":
+            r[dropdown_var_name] = md_view.choice_text[dropdown_var_name][r[dropdown_var_name]]
     return r
 
-def collapse_radio_groups(r: dict, md: list[dict]) -> dict:
+def collapse_radio_groups(r: dict, md_view: redcap_helpers.MetadataView) -> dict:
     '''Returns a formatted version of record r where all radio button groups contain only 1 True value.
     {"radio_button_group": {
             "choice_1": True
         }
     }
     Intended to simplify the process of determining which radio button to select.
+    md_view is the output of redcap_helpers.parse_metadata().
     '''
     num_of_collapsed_radio_groups = 0
 
@@ -172,126 +245,149 @@ def collapse_radio_groups(r: dict, md: list[dict]) -> dict:
     # groups = [i for i in r if type(r[i]) == dict]     # Any dictionaries *in the data dictionary* are radio buttons
 
     # Now, trust the metadata dict instead:
-    groups = [field['field_name'] for field in md if field['field_type'] == 'radio']
-
-    def _contains_only_one_true(iterable) -> bool:
-        '''Returns whether or not 'iterable' contains only a single True value.
-        Thank you Jon Clements and Antti Haapala! https://stackoverflow.com/a/16801605
-        '''
-        i = iter(iterable)
-        return any(i) and not any(i)
+    groups = [f for f in md_view.field_types if f in md_view.radios]    # Metadata order, so errors name the same group every run
+    if not groups:
+        return r
 
     for radio_group in groups:
-        vals = r[radio_group].values()
-        if any(not isinstance(x, bool) for x in vals):
-            raise TypeError(f"Radio button groups should only contain boolean values: {r[radio_group]}")
-        if not _contains_only_one_true(vals):
+        if radio_group not in r:
+            # The record may only contain the fields used by the template PDF
+            continue
+        true_keys = [k for k, v in r[radio_group].items() if v is True]
+        if len(true_keys) != 1:
+            # Only sweep the group's values for non-booleans once it's known to be invalid, to give a clearer error
+            if any(not isinstance(v, bool) for v in r[radio_group].values()):
+                raise TypeError(f"Radio button groups should only contain boolean values: {r[radio_group]}")
             raise ValueError(f"Radio button groups should contain exactly 1 True value: {r[radio_group]}")
         if len(r[radio_group]) > 1:
             # Remove all k/v pairs from r[radio_group], leaving only the field that is True:
-            for k in r[radio_group]:
-                if r[radio_group][k]:
-                    # If a "True" is found in r[radio_group], assign r[radio_group] a new dictionary that only contains {key:True}
-                    r[radio_group] = dict([(k, r[radio_group][k])])
-                    num_of_collapsed_radio_groups += 1
-                    break
+            r[radio_group] = {true_keys[0]: True}
+            num_of_collapsed_radio_groups += 1
     # print(f">>> Collapsed {num_of_collapsed_radio_groups} radio button fields")
     return r
 
-def prepare_for_fill(record: dict, md: list[dict]) -> dict:
-    r = convert_checkboxes_and_radio_buttons(record, md)
-    r = convert_dropdowns_to_strings(r, md)
-    r = collapse_radio_groups(r, md)
+def prepare_for_fill(record: dict, md_view: redcap_helpers.MetadataView) -> dict:
+    # Skip any conversion whose field type doesn't appear in the project at all
+    has_radio = bool(md_view.radios)
+    has_cb = bool(md_view.checkboxes)
+    has_dropdown = bool(md_view.dropdowns)
+
+    r = record
+    if has_radio or has_cb:
+        r = convert_checkboxes_and_radio_buttons(r, md_view)
+    if has_dropdown:
+        r = convert_dropdowns_to_strings(r, md_view)
+    if has_radio:
+        r = collapse_radio_groups(r, md_view)
     return r
 
-def fill_pdf(input_pdf_path: Path, output_pdf_path: Path, data_dict: dict) -> None:
+def _fill_widget(annotation: pdfrw.PdfDict, is_grouped: bool, value) -> None:
+    '''Writes value into a single widget annotation (see _iter_widgets() for is_grouped).
+    '''
+    if not is_grouped:                              ### Isolated fields (has a '/T' key)
+        if isinstance(value, bool):                 # Checkboxes
+            annotation.update(_CHECKED if value else _UNCHECKED)
+        else:                                       # Text field
+            annotation.update(pdfrw.PdfDict(
+                AP='', V=value)
+            )
+
+    else:                                           ### Grouped fields (has a '/Parent' -> '/T' key)
+        if isinstance(value, dict) and len(value) != 0:     # Radio buttons
+            selected_radio_button = _pdf_name(next(iter(value)))
+            if(selected_radio_button in annotation[APPEARANCE_KEY][D_KEY].keys()):
+                # Page 441 of:
+                # https://www.adobe.com/content/dam/acom/en/devnet/pdf/pdfs/PDF32000_2008.pdf
+                annotation[PARENT_KEY].update(pdfrw.PdfDict(
+                    V=selected_radio_button)
+                )
+                annotation.update(pdfrw.PdfDict(
+                    AS=selected_radio_button)
+                )
+        elif isinstance(value, bool):               # Linked checkboxes (across multiple pages?)
+            annotation.update(_CHECKED if value else _UNCHECKED)
+        else:                                       # Linked text fields (across multiple pages?)
+            annotation[PARENT_KEY].update(pdfrw.PdfDict(
+                AP='', V=value)
+            )
+
+def fill_pdf(template_pdf: pdfrw.PdfReader, output_pdf_path: Path, data_dict: dict) -> None:
     '''Main function to handle filling in PDF fields.
-    Uses data_dict to populate fields from the template in input_pdf_path, writing the filled-in PDF to output_pdf_path.
+    Uses data_dict to populate fields of the parsed template PDF template_pdf, writing the filled-in PDF to output_pdf_path.
     '''
-    template_pdf = pdfrw.PdfReader(input_pdf_path)
-    for page in template_pdf.pages:
-        annotations = page[ANNOT_KEY]
-        if annotations is None:
-            continue
-        for annotation in annotations:
-            if annotation[SUBTYPE_KEY] == WIDGET_SUBTYPE_KEY:
-                if annotation[ANNOT_FIELD_KEY]:                 ### Isolated fields (has a '/T' key)
-                    key = annotation[ANNOT_FIELD_KEY][1:-1]
-                    if key in data_dict.keys():
-                        if type(data_dict[key]) == bool:        # Checkboxes
-                            if data_dict[key] == True:
-                                annotation.update(pdfrw.PdfDict(
-                                    AS=pdfrw.PdfName('Yes'), V=pdfrw.PdfName('Yes'))
-                                )
-                            else:
-                                annotation.update(pdfrw.PdfDict(
-                                    AS=pdfrw.PdfName('Off'), V=pdfrw.PdfName('Off'))
-                                )
-                        else:                                   # Text field
-                            annotation.update(pdfrw.PdfDict(
-                                AP='', V=data_dict[key])
-                            )
-                
-                elif annotation[PARENT_KEY][ANNOT_FIELD_KEY]:   ### Grouped fields (has a '/Parent' -> '/T' key)
-                    group = annotation[PARENT_KEY][ANNOT_FIELD_KEY][1:-1]
-                    if group in data_dict.keys():
-                        if type(data_dict[group]) == dict and len(data_dict[group]) != 0:       # Radio buttons
-                            selected_radio_button = pdfrw.PdfName(list(data_dict[group].keys())[0])
-                            if(selected_radio_button in annotation[APPEARANCE_KEY][D_KEY].keys()):
-                                # Page 441 of:
-                                # https://www.adobe.com/content/dam/acom/en/devnet/pdf/pdfs/PDF32000_2008.pdf
-                                annotation[PARENT_KEY].update(pdfrw.PdfDict(
-                                    V=selected_radio_button)
-                                )
-                                annotation.update(pdfrw.PdfDict(
-                                    AS=selected_radio_button)
-                                )
-                        elif type(data_dict[group]) == bool:            # Linked checkboxes (across multiple pages?)
-                            if data_dict[group] == True:
-                                annotation.update(pdfrw.PdfDict(
-                                    AS=pdfrw.PdfName('Yes'), V=pdfrw.PdfName('Yes'))
-                                )
-                            else:
-                                annotation.update(pdfrw.PdfDict(
-                                    AS=pdfrw.PdfName('Off'), V=pdfrw.PdfName('Off'))
-                                )
-                        else:                                           # Linked text fields (across multiple pages?)
-                            annotation[PARENT_KEY].update(pdfrw.PdfDict(
-                                AP='', V=data_dict[group])
-                            )
-    
+    # Most widgets in a large form usually have no data (empty REDCap fields), so skip them before any other work
+    widgets = [(annotation, is_grouped, data_dict[key])
+               for annotation, key, is_grouped in _iter_widgets(template_pdf) if key in data_dict]
+
+    for widget in widgets:
+        _fill_widget(*widget)
+
     if not output_pdf_path.parent.exists():
-        print(f"    Location of output PDF '{output_pdf_path}' doesn't exist; creating: {output_pdf_path.parent}")
+        logger.info("Location of output PDF '%s' doesn't exist; creating: %s", output_pdf_path, output_pdf_path.parent)
         output_pdf_path.parent.mkdir(parents=True, exist_ok=True)
     
     template_pdf.Root.AcroForm.update(pdfrw.PdfDict(NeedAppearances=pdfrw.PdfObject('true')))
-    pdfrw.PdfWriter().write(output_pdf_path, template_pdf)
+    # Serialize into memory so the file gets one large write instead of pdfrw's many small ones,
+    # then move it into place so a failed write never leaves a truncated output PDF behind
+    buf = io.BytesIO()
+    pdfrw.PdfWriter().write(buf, template_pdf)
+    tmp_output_pdf_path = output_pdf_path.with_name(output_pdf_path.name + '.tmp')
+    try:
+        tmp_output_pdf_path.write_bytes(buf.getbuffer())    # A view of the buffer, not a second copy of the PDF
+        os.replace(tmp_output_pdf_path, output_pdf_path)
+    except BaseException:
+        # Don't leave a partially written temporary file next to the output PDF
+        tmp_output_pdf_path.unlink(missing_ok=True)
+        raise
     return
 
 ################################################################
 ################################################################
 
 if __name__ == '__main__':
-    RECORD,REDCAP_UNIQUE_IDENTIFIER,PDF_TEMPLATE,OUTPUT = get_cmd_line_input(parser.parse_args())
-    print()
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO if args.verbose else logging.WARNING,
+        format="%(levelname)s: %(message)s",
+    )
+    RECORD,REDCAP_UNIQUE_IDENTIFIER,PDF_TEMPLATE,OUTPUT = get_cmd_line_input(args)
 
     secrets = load_secrets(SECRETS_FILE)
-    print("Loaded secrets file")
+    logger.info("Loaded secrets file")
+
+    metadata_was_cached = redcap_helpers.get_metadata.is_cached(secrets)
+
+    # Parse the template PDF while the metadata request is in flight
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        metadata_future = executor.submit(redcap_helpers.get_metadata, secrets)
+
+        logger.info("Using PDF template:  %s", PDF_TEMPLATE)
+        template_pdf = pdfrw.PdfReader(PDF_TEMPLATE)
+        pdf_fields = get_pdf_fields(template_pdf)
+
+        proj_metadata = metadata_future.result()
+        logger.info("Got project metadata")
+        # print(redcap_helpers.get_fields_and_types(proj_metadata))
 
-    proj_metadata = redcap_helpers.get_metadata(secrets)
-    print("Got project metadata")
-    # print(redcap_helpers.get_fields_and_types(proj_metadata))
+        # proj_multiple_choice_text = redcap_helpers.get_multiple_choice_text(proj_metadata)
+        # print(proj_multiple_choice_text)
 
-    # proj_multiple_choice_text = redcap_helpers.get_multiple_choice_text(proj_metadata)
-    # print(proj_multiple_choice_text)
+    proj_metadata_view = redcap_helpers.parse_metadata(proj_metadata)
+    if metadata_was_cached and get_unknown_pdf_fields(pdf_fields, proj_metadata_view):
+        # The PDF may use fields added to the project since the metadata was cached
+        logger.info("Template PDF has fields missing from the cached project metadata; fetching fresh metadata")
+        proj_metadata = redcap_helpers.get_metadata(secrets, use_cache=False)
+        proj_metadata_view = redcap_helpers.parse_metadata(proj_metadata)
 
-    record = redcap_helpers.get_record(secrets, REDCAP_UNIQUE_IDENTIFIER, RECORD)
-    print(f"Got record {RECORD} (identified by '{REDCAP_UNIQUE_IDENTIFIER}')")
+    # Only request the REDCap variables that the template PDF can hold (or the whole record, if record_fields is None)
+    record_fields = get_record_fields(pdf_fields, proj_metadata_view, REDCAP_UNIQUE_IDENTIFIER)
+    record = redcap_helpers.get_record(secrets, REDCAP_UNIQUE_IDENTIFIER, RECORD, record_fields)
+    logger.info("Got record %s (identified by '%s')", RECORD, REDCAP_UNIQUE_IDENTIFIER)
 
-    prepared_data_dict = prepare_for_fill(record, proj_metadata)
-    print("Prepared Python dictionary:", prepared_data_dict)
+    prepared_data_dict = prepare_for_fill(record, proj_metadata_view)
+    # Lazy formatting: the (possibly large) dictionary is only converted to a string when debugging
+    logger.debug("Prepared Python dictionary: %s", prepared_data_dict)
 
-    print("Using PDF template:  " + str(PDF_TEMPLATE))
-    fill_pdf(PDF_TEMPLATE, OUTPUT, prepared_data_dict)
-    print("PDF written to:      " + str(OUTPUT))
-    print("Done!")
+    fill_pdf(template_pdf, OUTPUT, prepared_data_dict)
+    logger.info("PDF written to:      %s", OUTPUT)
+    logger.info("Done!")
@@ -1,58 +1,179 @@
 # Contains functions and helpers to obtain and interact with REDCap API data.
 
+import functools
+import hashlib
 import json
+import logging
+import os
+import re
+import time
 import requests
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from pathlib import Path
+from dataclasses import dataclass
+
+try:
+    # orjson decodes straight from bytes and is notably faster on large metadata payloads
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+logger = logging.getLogger(__name__)
+
+# (connect, read) timeouts in seconds for every REDCap API call
+REQUEST_TIMEOUT = (5, 30)
+
+# Shared across API calls so the metadata and record requests reuse one keep-alive connection
+session = requests.Session()
+session.headers.update({'Accept-Encoding': 'gzip'})
+# Pool sized for the concurrent metadata + record requests; retries only cover failed connections (POSTs aren't resent after a response)
+_adapter = HTTPAdapter(pool_connections=2, pool_maxsize=2, max_retries=Retry(total=3, backoff_factor=0.3))
+session.mount('https://', _adapter)
+session.mount('http://', _adapter)
+
+# Parsed metadata is cached here between runs; set REDCAP_PDF_NOCACHE=1 to always fetch fresh metadata
+CACHE_DIR = Path.home() / '.cache' / 'redcap_pdf'
+METADATA_CACHE_TTL = 3600   # Seconds
+
+def _disk_cache(ttl: int, key):
+    '''Decorator that caches the JSON-serializable return value of a function taking secrets_dict in
+    CACHE_DIR/{key(secrets_dict)}.json, reusing it for ttl seconds after it was written.
+    Caching is best-effort: an unreadable or unwritable cache falls back to calling the function.
+    The decorated function also accepts use_cache=False to skip reading (but still refresh) the cache,
+    and gains an is_cached(secrets_dict) attribute that says whether the next call would be served from the cache.
+    '''
+    def decorator(func):
+        def _is_fresh(cache_file: Path) -> bool:
+            try:
+                return time.time() - cache_file.stat().st_mtime < ttl
+            except OSError:
+                return False    # Missing or unreadable cache file
+
+        @functools.wraps(func)
+        def wrapper(secrets_dict: dict, use_cache: bool = True):
+            if os.environ.get('REDCAP_PDF_NOCACHE') == '1':
+                return func(secrets_dict)
+            cache_file = CACHE_DIR / f"{key(secrets_dict)}.json"
+            if use_cache and _is_fresh(cache_file):
+                try:
+                    return _json_loads(cache_file.read_bytes())
+                except (OSError, ValueError):
+                    pass    # Unreadable or corrupt cache file
+            result = func(secrets_dict)
+            try:
+                CACHE_DIR.mkdir(parents=True, exist_ok=True)
+                tmp_file = cache_file.with_suffix('.tmp')
+                tmp_file.write_text(json.dumps(result), encoding='utf-8')
+                os.replace(tmp_file, cache_file)
+            except OSError:
+                pass
+            return result
+
+        def is_cached(secrets_dict: dict) -> bool:
+            if os.environ.get('REDCAP_PDF_NOCACHE') == '1':
+                return False
+            return _is_fresh(CACHE_DIR / f"{key(secrets_dict)}.json")
+
+        wrapper.is_cached = is_cached
+        return wrapper
+    return decorator
+
+def _metadata_cache_key(secrets_dict: dict) -> str:
+    '''Returns a cache key identifying a REDCap project.
+    Includes the API key because projects on the same REDCap instance share one API URL (hashed, so it isn't stored in plain text).
+    '''
+    return hashlib.sha256(f"{secrets_dict['url']}\n{secrets_dict['api_key']}".encode()).hexdigest()
+
 ################################################################
 #### Metadata behavior
 ################################################################
 
-def _request_metadata(secrets_dict: dict) -> str:
+# Separator between multiple-choice options in REDCap metadata
+_CHOICE_SEP = re.compile(r'\s*\|\s*')
+
+def _request_metadata(secrets_dict: dict) -> bytes:
     '''Makes a REDCap API call for a REDCap project's metadata.
-    Returns the text of the API response.
+    Returns the raw bytes of the API response.
     '''
     metadata_request = {
         'token': secrets_dict['api_key'],
         'content': 'metadata',
         'format': 'json',
     }
-    r = requests.post(secrets_dict['url'],data=metadata_request)
+    r = session.post(secrets_dict['url'],data=metadata_request,timeout=REQUEST_TIMEOUT)
     #print('>>> Metadata request HTTP Status: ' + str(r.status_code))
-    return r.text
+    return r.content
 
+@_disk_cache(ttl=METADATA_CACHE_TTL, key=_metadata_cache_key)
 def get_metadata(secrets_dict: dict) -> list[dict]:
     '''Returns a list of dictionaries that contain metadata for a REDCap project's fields.
+    Results are cached on disk for METADATA_CACHE_TTL seconds (see _disk_cache()).
     '''
-    raw_metadata_string = _request_metadata(secrets_dict)
-    md = json.loads(raw_metadata_string)
+    md = _json_loads(_request_metadata(secrets_dict))
     if type(md) == dict and md['error']:
-        print(f"REDCap API returned an error while fetching metadata: {md['error']}")
+        logger.error("REDCap API returned an error while fetching metadata: %s", md['error'])
         exit(1)
     return md
 
-def _extract_field(md: list[dict], which_field: str) -> list[str]:
-    '''Parses REDCap metadata and returns a list of variable names of the desired field type.
-    Originally intended for use with radio buttons (which_field='radio') and checkboxes (which_field='checkbox').
+MULTIPLE_CHOICE_FIELD_TYPES = ('radio', 'checkbox', 'dropdown')
+
+@dataclass
+class MetadataView:
+    '''Every view of a REDCap project's metadata that this tool needs, computed together by parse_metadata().
+    * radios, checkboxes, dropdowns:    names of the fields of each type
+    * field_types:                      maps field names to their REDCap-defined types, in metadata order
+    * choice_text:                      maps multiple-choice field names to a dict of {raw_value: display_text}
+                                        (see get_multiple_choice_text())
+    * form_complete_fields:             names of each instrument's '{form_name}_complete' status variable, which
+                                        records contain but the metadata doesn't list as fields
+    '''
+    radios: frozenset[str]
+    checkboxes: frozenset[str]
+    dropdowns: frozenset[str]
+    field_types: dict[str, str]
+    choice_text: dict[str, dict[str, str]]
+    form_complete_fields: frozenset[str]
+
+def parse_metadata(md: list[dict]) -> MetadataView:
+    '''Returns a MetadataView of REDCap metadata dictionary md, built in a single pass over its fields.
     '''
-    result = []
+    fields_by_type = {field_type: [] for field_type in MULTIPLE_CHOICE_FIELD_TYPES}
+    field_types = dict()
+    choice_text = dict()
+    form_complete_fields = set()
     for field in md:
-        if field['field_type'] == which_field:
-            result.append(field['field_name'])
-    return result
+        field_name = field['field_name']
+        field_type = field['field_type']
+        field_types[field_name] = field_type
+        if field.get('form_name'):
+            form_complete_fields.add(f"{field['form_name']}_complete")
+        if field_type in fields_by_type:
+            fields_by_type[field_type].append(field_name)
+        # REDCap stores multiple-choice options (and calculations, sliders, etc.) in 'select_choices_or_calculations'
+        if field.get('select_choices_or_calculations'):
+            choice_text[field_name] = _parse_choices(field['select_choices_or_calculations'])
+    return MetadataView(
+        radios=frozenset(fields_by_type['radio']),
+        checkboxes=frozenset(fields_by_type['checkbox']),
+        dropdowns=frozenset(fields_by_type['dropdown']),
+        field_types=field_types,
+        choice_text=choice_text,
+        form_complete_fields=frozenset(form_complete_fields),
+    )
 
 def get_radio_buttons_checkboxes(md: list[dict]) -> tuple[list[str], list[str]]:
     '''Returns a 2-tuple of lists: the first a list of radio button fields, and the second a list of checkbox fields
     (as defined in REDCap metadata dictionary md).
     '''
-    return (_extract_field(md, 'radio'), _extract_field(md, 'checkbox'))
+    view = parse_metadata(md)
+    return ([f for f in view.field_types if f in view.radios], [f for f in view.field_types if f in view.checkboxes])
 
 def get_fields_and_types(md: list[dict]) -> dict[str:str]:
     '''Returns a dictionary mapping REDCap field names to their REDCap-defined types.
     '''
-    result = dict()
-    for field in md:
-        result[field['field_name']] = field['field_type']
-    return result
+    return parse_metadata(md).field_types
 
 def get_multiple_choice_text(md: list[dict]) -> dict[str:dict]:
     '''Returns a dictionary mapping multiple-choice REDCap variable names to
@@ -65,34 +186,43 @@ def get_multiple_choice_text(md: list[dict]) -> dict[str:dict]:
             texts = {'radio_buttons_1': {'1': 'Option A', '2': 'Option B'}}
             texts['radio_buttons_1']['1'] == 'Option A'     # True
     '''
-    texts = dict()
-    for field in md:
-        # First verify if field is a multiple-choice field
-        if ('select_choices_or_calculations' in field and \
-                type(field) == dict and \
-                field['select_choices_or_calculations']):
-            # REDCap API returns multiple choice options in the format
-            #   "{raw_value}, {display_text} | {raw_value}, {display_text} | ... "
-            # Create the dict that maps raw_value to display_text:
-            sub_dict = dict()
-            choices = field['select_choices_or_calculations'].split(' | ')
-            # Sometimes REDCap skips the spaces between the vertical bar '|' separating choices....
-            if len(choices) == 1:
-                choices = field['select_choices_or_calculations'].split('|')
-            for option in choices:
-                option_fragments = option.strip().split(', ')
-                # option_fragments[0] is raw_value, everything else is display_text (which could have a ', ' in it)
-                sub_dict[option_fragments[0]] = ', '.join(option_fragments[1:])
-            texts[field['field_name']] = sub_dict
-    return texts
+    return parse_metadata(md).choice_text
+
+def _parse_choices(raw_choices: str) -> dict[str:str]:
+    '''Returns a dict mapping each option's raw value to its display text,
+    parsed from a REDCap multiple-choice field's 'select_choices_or_calculations' string.
+    '''
+    # REDCap API returns multiple choice options in the format
+    #   "{raw_value}, {display_text} | {raw_value}, {display_text} | ... "
+    # Create the dict that maps raw_value to display_text:
+    # (Sometimes REDCap skips the spaces around the vertical bar '|' separating choices, so _CHOICE_SEP allows any spacing)
+    sub_dict = dict()
+    for option in _CHOICE_SEP.split(raw_choices):
+        # Everything before the first ', ' is raw_value, everything after is display_text (which could have a ', ' in it)
+        raw_value, _, display_text = option.strip().partition(', ')
+        sub_dict[raw_value] = display_text
+    return sub_dict
+
+def build_field_index(md: list[dict]) -> dict[str, tuple]:
+    '''Returns a dictionary mapping REDCap field names to a 2-tuple of (field_type, choices).
+    choices is the dict returned by _parse_choices() for radio buttons, checkboxes, and dropdowns, or None otherwise.
+    Example:
+        index = {'radio_buttons_1': ('radio', {'1': 'Option A', '2': 'Option B'}), 'text_1': ('text', None)}
+    '''
+    view = parse_metadata(md)
+    return {
+        field_name: (field_type, view.choice_text.get(field_name) if field_type in MULTIPLE_CHOICE_FIELD_TYPES else None)
+        for field_name, field_type in view.field_types.items()
+    }
 
 ################################################################
 #### Records behavior
 ################################################################
 
-def _request_record(secrets_dict: dict, redcap_unique_identifier: str, record_id) -> str:
+def _request_record(secrets_dict: dict, redcap_unique_identifier: str, record_id, fields: list[str] = None) -> bytes:
     '''Makes a REDCap API call for a single record from a REDCap project.
-    Returns the text of the API response.
+    If fields is given, only those REDCap variables are requested (checkbox fields by their base name).
+    Returns the raw bytes of the API response.
     '''
     record_request = {
         'token': secrets_dict['api_key'],
@@ -101,18 +231,24 @@ def _request_record(secrets_dict: dict, redcap_unique_identifier: str, record_id
         'type': "flat",
         'filterLogic': f"[{redcap_unique_identifier}] = '{record_id}'"
     }
-    r = requests.post(secrets_dict['url'],data=record_request)
+    if fields:
+        record_request['fields'] = ','.join(fields)
+    r = session.post(secrets_dict['url'],data=record_request,timeout=REQUEST_TIMEOUT)
     #print('>>> Record request HTTP Status: ' + str(r.status_code))
-    return r.text
+    return r.content
 
-def get_record(secrets_dict: dict, redcap_unique_identifier: str, record_id: str) -> dict:
+def get_record(secrets_dict: dict, redcap_unique_identifier: str, record_id: str, fields: list[str] = None) -> dict:
     '''Returns a dictionary that contains data of a single REDCap record,
     identified by the value of record_id in redcap_unique_identifier.
+    If fields is given, the record only contains those REDCap variables (otherwise, all of them).
     '''
-    raw_record_data = _request_record(secrets_dict, redcap_unique_identifier, record_id)
-    record = json.loads(raw_record_data)
+    record = _json_loads(_request_record(secrets_dict, redcap_unique_identifier, record_id, fields))
     if type(record) == dict and record['error']:
-        print(f"REDCap API returned an error while fetching record {record_id}: {record['error']}")
+        logger.error("REDCap API returned an error while fetching record %s: %s", record_id, record['error'])
+        if fields:
+            # The requested fields come from the project metadata, which may be cached from before a field was renamed or deleted
+            logger.error("If fields were recently renamed or deleted in REDCap, the cached project metadata may be out of date: "
+                         "delete %s or set REDCAP_PDF_NOCACHE=1 and try again.", CACHE_DIR)
         exit(1)
     if type(record) == list :
         if len(record) < 1: